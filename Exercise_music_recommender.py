@@ -8,12 +8,18 @@ import pickle
 from system.energy_calculator import FuzzyController, EnergyCalculator
 from system.hybrid_music_recommender import ALSRecommender, KmeansContentBasedRecommender, HybridRecommender
 from system.two_stage_system import MusicRecommender2Stages
+from system.candidate_pools import CandidatePoolStore, HISTORY_FILE, model_fingerprint
+from system.quantized_factors import QuantizedItemFactors
+from system.energy_index import EnergyBucketIndex
+from system.heart_rate_store import HeartRateStore
+from system.profiling import RecommendationProfiler
 
 BASE_DIR = os.getcwd()
 RESOURCES_DIR = os.path.join(BASE_DIR, 'resources')
 DATA_DIR = os.path.join(RESOURCES_DIR, 'data')
 MODEL_DIR = os.path.join(RESOURCES_DIR, 'models')
 MATRICES_DIR = os.path.join(RESOURCES_DIR, 'matrices')
+POOLS_DIR = os.path.join(RESOURCES_DIR, 'pools')
 
 # Clear cache
 #st.cache_data.clear()
@@ -65,6 +71,10 @@ def load_index_data(base_path, file_name):
 def create_df_music_info(df_music_source):    
     return df_music_source[['track_id', 'name', 'artist', 'energy', 'duration_ms']]
 
+@st.cache_resource
+def create_heart_rate_store(_df_heart_rates_source):
+    return HeartRateStore(_df_heart_rates_source)
+
 @st.cache_data
 def gym_members_count(df_gym):
     return df_gym.shape[0]
@@ -80,6 +90,40 @@ def load_pickle(base_path, file_name):
         st.error(f"File {file_name} not found in {base_path}")
         return None
 
+@st.cache_resource
+def load_candidate_pools(base_path, file_name, modified_time, history_path, history_modified_time, _track_uniques, _interaction_matrix, _als_model, _quantized_factors):
+    # The modification times are part of the cache key so a rebuilt pool file or a new listening history is picked up
+    file_path = os.path.join(base_path, file_name)
+    if os.path.exists(file_path):
+        # Once quantized factors are in use the model points at the mapped file, whose fingerprint was stored at export
+        fingerprint = _quantized_factors.fingerprint if _quantized_factors is not None else model_fingerprint(_als_model)
+        return CandidatePoolStore(file_path, _track_uniques, _interaction_matrix, fingerprint=fingerprint, history_path=history_path)
+    return None # Pools are optional, sessions fall back to live scoring
+
+@st.cache_resource
+def load_quantized_factors(base_path, dir_name, _als_model):
+    directory = os.path.join(base_path, dir_name)
+    if not QuantizedItemFactors.exported_precisions(directory):
+        return None # Optional, the full-precision ALS model is used otherwise
+    quantized_factors = QuantizedItemFactors.load_faster(directory)
+    if quantized_factors is None:
+        st.info(f"Not using the quantized item factors in {directory}: no export scored faster than full precision when it was exported.")
+        return None
+    try:
+        quantized_factors.replace_model_factors(_als_model)
+    except ValueError as error:
+        st.warning(f"Ignoring the quantized item factors in {directory}: {error}. Export them again with `python -m system.quantized_factors --export`.")
+        return None
+    return quantized_factors
+
+@st.cache_resource
+def create_energy_index(_df_music_info, _track_uniques, _id_to_cluster):
+    return EnergyBucketIndex.from_catalog(_df_music_info, _track_uniques, _id_to_cluster)
+
+@st.cache_resource
+def load_profiler():
+    return RecommendationProfiler.from_env() # None unless MUSIC_RECOMMENDER_PROFILE_DIR is set
+
 
 st.title("Exercise Music Recommender System")
 
@@ -130,6 +174,18 @@ if interaction_matrix_user_item is None:
     st.error("Error loading interaction matrix. Please check the matrix in the resources/matrices directory.")
     st.stop()
 
+heart_rate_store = create_heart_rate_store(df_heart_rates)
+quantized_factors = load_quantized_factors(MODEL_DIR, 'quantized', als_model)
+energy_index = create_energy_index(df_music_info, track_uniques, id_to_cluster)
+profiler = load_profiler()
+
+pools_path = os.path.join(POOLS_DIR, 'candidate_pools.bin')
+history_path = os.path.join(DATA_DIR, HISTORY_FILE)
+candidate_pools = load_candidate_pools(POOLS_DIR, 'candidate_pools.bin', os.path.getmtime(pools_path) if os.path.exists(pools_path) else None,
+                                       history_path, os.path.getmtime(history_path), track_uniques, interaction_matrix_user_item, als_model, quantized_factors)
+if candidate_pools is not None and candidate_pools.stale_reason is not None:
+    st.warning(f"Candidate pools are stale because {candidate_pools.stale_reason}. Sessions use live scoring until they are rebuilt with `python -m system.candidate_pools`.")
+
 st.markdown(f"### Select your user ID")
 
 
@@ -139,9 +195,9 @@ session_button_caption = "Start session" if not st.session_state.session_started
 
 if st.session_state.session_started:
     energy_calculator = EnergyCalculator(df_gym.iloc[st.session_state.user_id], st.session_state.user_heart_rates, st.session_state.session_minute)
-    als_recommender = ALSRecommender(interaction_matrix_user_item, track_uniques, df_music_info, als_model)
+    als_recommender = ALSRecommender(interaction_matrix_user_item, track_uniques, df_music_info, als_model, quantized_factors, energy_index)
     hybrid_recommender = HybridRecommender(interaction_matrix_user_item, track_uniques, df_music_info, df_users, id_to_cluster, st.session_state.recommendations, als_recommender=als_recommender)
-    music_recommender_2_stages = MusicRecommender2Stages(energy_calculator, hybrid_recommender, st.session_state.user_id, df_music_info)
+    music_recommender_2_stages = MusicRecommender2Stages(energy_calculator, hybrid_recommender, st.session_state.user_id, df_music_info, profiler=profiler)
     st.markdown(f"### Welcome user {st.session_state.user_id + 1}")
 
 
@@ -150,15 +206,15 @@ if st.session_state.session_started:
 if st.button(session_button_caption):
     st.session_state.user_id = selected_user_id
     st.session_state.session_minute = 0
-    st.session_state.user_heart_rates = df_heart_rates[df_heart_rates['User_ID'] == st.session_state.user_id]['Heart_Rate'].tolist()
+    st.session_state.user_heart_rates = heart_rate_store.user_series(st.session_state.user_id)
     st.session_state.session_started = True
 
     user_listened_songs = df_users[df_users['user_id'] == user_uniques[st.session_state.user_id]].track_id
     st.session_state.listened_songs = df_music_info[df_music_info['track_id'].isin(user_listened_songs)]
 
-    als_recommender = ALSRecommender(interaction_matrix_user_item, track_uniques, df_music_info, als_model)
+    als_recommender = ALSRecommender(interaction_matrix_user_item, track_uniques, df_music_info, als_model, quantized_factors, energy_index)
     hybrid_recommender = HybridRecommender(interaction_matrix_user_item, track_uniques, df_music_info, df_users, id_to_cluster, als_recommender=als_recommender)
-    music_recommender_2_stages = MusicRecommender2Stages(None, hybrid_recommender, st.session_state.user_id, df_music_info)
+    music_recommender_2_stages = MusicRecommender2Stages(None, hybrid_recommender, st.session_state.user_id, df_music_info, candidate_pools, profiler)
     music_recommender_2_stages.make_recommendations(n=100)
     st.session_state.recommendations = music_recommender_2_stages.get_recommendations()
     st.rerun()
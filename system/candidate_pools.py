@@ -0,0 +1,204 @@
+import argparse
+import hashlib
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from system.hybrid_music_recommender import ALSRecommender, HybridRecommender
+from system.resources import Resources
+from system.shared_model import SharedModel, SharedResources
+
+# File layout: header | index (one entry per user index) | records (fixed width, grouped by user)
+MAGIC = b'CANDPOOL'
+VERSION = 2
+HEADER_FORMAT = '<8sIIIIdQQq' # ..., built_at, model fingerprint, listening history size and mtime
+HEADER_SIZE = 64
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('count', '<i4'), ('history_count', '<i4')])
+RECORD_DTYPE = np.dtype([('item_code', '<i4'), ('score', '<f4'), ('energy', '<f4')])
+HISTORY_FILE = 'User Listening History_reduced.csv'
+
+
+def _history_counts(interaction_matrix):
+    return np.diff(interaction_matrix.tocsr().indptr)
+
+
+def model_fingerprint(als_model):
+    # Changes whenever the model is retrained, even with the same shape
+    if hasattr(als_model, 'to_cpu'):
+        als_model = als_model.to_cpu()
+    item_factors = np.ascontiguousarray(als_model.item_factors, dtype=np.float32)
+    return int.from_bytes(hashlib.blake2b(item_factors.data, digest_size=8).digest(), 'little')
+
+
+def history_fingerprint(history_path):
+    # The listening history CSV drives the content-based term of every pool
+    stat = os.stat(history_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _build_user_pools(resources, user_indexes, n, alpha):
+    als_recommender = ALSRecommender(resources.interaction_matrix, resources.track_uniques, resources.df_music_info, resources.als_model)
+    hybrid_recommender = HybridRecommender(resources.interaction_matrix, resources.track_uniques, resources.df_music_info, resources.df_users,
+                                           resources.id_to_cluster, als_recommender=als_recommender, alpha=alpha)
+    n_history_users = len(resources.df_users['user_id'].unique()) # User indexes follow the order of the listening history
+    pools = []
+    for user_index in user_indexes:
+        if user_index >= n_history_users:
+            pools.append((user_index, None)) # No listening history for this user: left to the live path
+            continue
+        hybrid_recommender.make_recommendations(user_index, n)
+        recommendations = hybrid_recommender.get_recommendations()
+        records = np.empty(len(recommendations), dtype=RECORD_DTYPE)
+        records['item_code'] = resources.track_uniques.get_indexer([track_id for track_id, _, _, _ in recommendations])
+        records['score'] = [similarity for _, _, similarity, _ in recommendations]
+        records['energy'] = [energy for _, energy, _, _ in recommendations]
+        pools.append((user_index, records))
+    return pools
+
+
+_worker_resources = None
+
+
+def _init_worker(spec, base_dir):
+    global _worker_resources
+    _worker_resources = SharedResources(SharedModel.attach(spec), base_dir)
+
+
+def _build_chunk(user_indexes, n, alpha):
+    return _build_user_pools(_worker_resources, user_indexes, n, alpha)
+
+
+def build_candidate_pools(resources, output_path, n=100, alpha=2, workers=1, chunk_size=256, base_dir=None):
+    n_users, n_items = resources.interaction_matrix.shape
+    fingerprint = model_fingerprint(resources.als_model)
+    history_size, history_mtime = history_fingerprint(os.path.join(resources.data_dir, HISTORY_FILE))
+    history_counts = _history_counts(resources.interaction_matrix)
+    chunks = [range(start, min(start + chunk_size, n_users)) for start in range(0, n_users, chunk_size)]
+
+    index = np.zeros(n_users, dtype=INDEX_DTYPE)
+    index['count'] = -1
+    index['history_count'] = history_counts
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    temporary_path = f"{output_path}.tmp"
+    shared_model = None
+    try:
+        with open(temporary_path, 'wb') as file:
+            file.write(b'\0' * (HEADER_SIZE + index.nbytes)) # Filled in once every record is written
+            offset = 0
+
+            def write_chunk(pools):
+                nonlocal offset
+                for user_index, records in pools:
+                    if records is None:
+                        continue
+                    file.write(records.tobytes())
+                    index['offset'][user_index] = offset
+                    index['count'][user_index] = len(records)
+                    offset += len(records)
+
+            if workers > 1:
+                shared_model = SharedModel.publish(resources)
+                context = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                         initargs=(shared_model.spec, base_dir)) as executor:
+                    for pools in executor.map(_build_chunk, chunks, [n] * len(chunks), [alpha] * len(chunks)):
+                        write_chunk(pools)
+            else:
+                for chunk in chunks:
+                    write_chunk(_build_user_pools(resources, chunk, n, alpha))
+
+            file.seek(0)
+            header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, n, n_users, n_items, time.time(), fingerprint, history_size, history_mtime)
+            file.write(header.ljust(HEADER_SIZE, b'\0'))
+            file.write(index.tobytes())
+        os.replace(temporary_path, output_path) # Readers never see a half-written file
+    finally:
+        if shared_model is not None:
+            shared_model.close()
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return int((index['count'] >= 0).sum())
+
+
+class CandidatePoolStore:
+    def __init__(self, path, track_uniques, interaction_matrix=None, max_age=None, fingerprint=None, history_path=None):
+        # fingerprint: model_fingerprint of the loaded model
+        self.track_uniques = track_uniques
+        with open(path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = struct.unpack_from(HEADER_FORMAT, self.buffer, 0)
+        magic, version, self.pool_size, n_users, n_items, self.built_at, built_fingerprint, history_size, history_mtime = header
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a candidate pool file of version {VERSION}")
+
+        self.index = np.frombuffer(self.buffer, dtype=INDEX_DTYPE, count=n_users, offset=HEADER_SIZE)
+        records_offset = HEADER_SIZE + self.index.nbytes
+        n_records = (len(self.buffer) - records_offset) // RECORD_DTYPE.itemsize
+        self.records = np.frombuffer(self.buffer, dtype=RECORD_DTYPE, count=n_records, offset=records_offset)
+
+        # Pools are stale as a whole if the catalog, model or listening history changed or they are too old,
+        # and per user if their interactions changed
+        self.stale_reason = None
+        if n_items != len(track_uniques):
+            self.stale_reason = "the catalog changed"
+        elif fingerprint is not None and fingerprint != built_fingerprint:
+            self.stale_reason = "the model was retrained"
+        elif history_path is not None and (history_size, history_mtime) != history_fingerprint(history_path):
+            self.stale_reason = "the listening history changed"
+        elif max_age is not None and time.time() - self.built_at > max_age:
+            self.stale_reason = "they are older than the maximum age"
+        self.all_stale = self.stale_reason is not None
+        self.history_counts = _history_counts(interaction_matrix) if interaction_matrix is not None else None
+
+    def is_fresh(self, user_index, n=100):
+        # Only the n the pools were built with: the hybrid re-ranking of a larger ALS top-n is not the live top-n for a smaller one
+        if self.all_stale or n != self.pool_size or user_index >= len(self.index):
+            return False
+        entry = self.index[user_index]
+        if entry['count'] < 0:
+            return False
+        if self.history_counts is not None and entry['history_count'] != self.history_counts[user_index]:
+            return False
+        return True
+
+    def get_recommendations(self, user_index, n=100):
+        # Same format as HybridRecommender.recommendations, or None when the live path should be used
+        if not self.is_fresh(user_index, n):
+            return None
+        entry = self.index[user_index]
+        records = self.records[entry['offset']:entry['offset'] + entry['count']]
+        track_ids = self.track_uniques[records['item_code']]
+        return [(track_id, float(energy), float(score), False) for track_id, energy, score in zip(track_ids, records['energy'], records['score'])]
+
+    def close(self):
+        self.index = None
+        self.records = None
+        self.buffer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute every user's hybrid candidate pool for constant-time session start")
+    parser.add_argument('--base-dir', default=None, help="Directory containing resources/ (defaults to the working directory)")
+    parser.add_argument('--output', default=None, help="Output file (defaults to resources/pools/candidate_pools.bin)")
+    parser.add_argument('--n', type=int, default=100, help="Candidates stored per user")
+    parser.add_argument('--alpha', type=float, default=2, help="Content-based weight of the hybrid recommender")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes sharing one copy of the model")
+    parser.add_argument('--chunk-size', type=int, default=256, help="Users per task")
+    args = parser.parse_args()
+
+    resources = Resources(args.base_dir)
+    output_path = args.output or os.path.join(resources.resources_dir, 'pools', 'candidate_pools.bin')
+    start = time.perf_counter()
+    built = build_candidate_pools(resources, output_path, args.n, args.alpha, args.workers, args.chunk_size, args.base_dir)
+    print(f"Wrote pools for {built}/{resources.interaction_matrix.shape[0]} users to {output_path} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,8 @@ from skfuzzy import control as ctrl
 import streamlit as st
 import matplotlib.pyplot as plt
 
+from system.heart_rate_store import HeartRateSeries
+
 
 class FuzzyController:
     def __init__(self):
@@ -104,26 +106,41 @@ class FuzzyController:
 
 
 class EnergyCalculator:
-    def __init__(self, df_gym_member, df_heart_rates, session_minute = 0, fuzzy_controller=None):
+    def __init__(self, df_gym_member, df_heart_rates, session_minute = 0, fuzzy_controller=None, use_smoothed=False):
         self.user_age = df_gym_member['Age']
-        self.df_heart_rates = df_heart_rates
+        self.df_heart_rates = df_heart_rates # List of per-minute BPMs or a HeartRateSeries from HeartRateStore
         self.sesion_minute = session_minute
-        if fuzzy_controller is None:
-            self.fuzzy_controller = FuzzyController()
-        else:
-            self.fuzzy_controller = fuzzy_controller
+        self.use_smoothed = use_smoothed # Only applies to a HeartRateSeries built with a smoothing window
+        self._fuzzy_controller = fuzzy_controller
+
+    @property
+    def fuzzy_controller(self):
+        # Built on first use: a prefetched song is served without running the inference
+        if self._fuzzy_controller is None:
+            self._fuzzy_controller = FuzzyController()
+        return self._fuzzy_controller
 
     def calculate_energy(self, plot_consequent=False, plot_antecedent=False):
         if self.sesion_minute == 0:
             return 0.6, None, None # Default energy for the first song
         if self.sesion_minute >= len(self.df_heart_rates):
             return -1, None, None # Indicates that the session has ended
+        bpm_current, bpm_before, bpm_variation = self.read_heart_rates()
+        print(f"Calculating energy for session minute {self.sesion_minute}")
+        print(f"Previous BPM: {bpm_before}, Current BPM: {bpm_current}, BPM Variation: {bpm_variation}")
+        return self.fuzzy_controller.calculate_energy(bpm_current, bpm_variation, self.user_age, plot_consequent, plot_antecedent), bpm_current, bpm_before
+
+    def read_heart_rates(self):
+        if isinstance(self.df_heart_rates, HeartRateSeries):
+            series = self.df_heart_rates
+            if self.use_smoothed and series.smoothed is not None:
+                bpm_current = series.smoothed[self.sesion_minute]
+                bpm_before = series.smoothed[self.sesion_minute - 1]
+                return bpm_current, bpm_before, bpm_current - bpm_before
+            return series.bpm[self.sesion_minute], series.bpm[self.sesion_minute - 1], series.variation[self.sesion_minute]
         bpm_current = self.df_heart_rates[self.sesion_minute]
         bpm_before = self.df_heart_rates[self.sesion_minute - 1]
-        bpm_variation = bpm_current - bpm_before
-        print(f"Calculating energy for session minute {self.sesion_minute}")
-        print(f"Previous BPM: {self.df_heart_rates[self.sesion_minute - 1]}, Current BPM: {bpm_current}, BPM Variation: {bpm_variation}")
-        return self.fuzzy_controller.calculate_energy(self.df_heart_rates[self.sesion_minute], bpm_variation, self.user_age, plot_consequent, plot_antecedent), bpm_current, bpm_before
+        return bpm_current, bpm_before, bpm_current - bpm_before
     
     def pass_song_duration(self, song_duration=2): # Song duration in minutes
         self.sesion_minute += song_duration
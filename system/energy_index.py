@@ -0,0 +1,74 @@
+import numpy as np
+
+
+class EnergyBucketIndex:
+    # Item codes ordered so every energy bucket (and cluster within it) is one contiguous block. Only the order is
+    # kept: factor rows are gathered from the model's own (possibly memory-mapped) item factors when scoring
+    def __init__(self, item_energies, n_buckets=20, item_clusters=None):
+        item_energies = np.asarray(item_energies, dtype=np.float64)
+        self.n_buckets = n_buckets
+        buckets = self._bucket(item_energies)
+
+        if item_clusters is not None:
+            self.cluster_values, cluster_codes = np.unique(np.asarray(item_clusters), return_inverse=True)
+        else:
+            self.cluster_values, cluster_codes = np.zeros(1), np.zeros(len(item_energies), dtype=np.int64)
+        self.n_clusters = len(self.cluster_values)
+        self.cluster_codes = {value: code for code, value in enumerate(self.cluster_values)}
+
+        keys = buckets * self.n_clusters + cluster_codes
+        order = np.argsort(keys, kind='stable')
+        self.item_codes = order # Position in the index -> item code of the ALS model
+        self.energies = item_energies[order]
+        self.offsets = np.searchsorted(keys[order], np.arange(n_buckets * self.n_clusters + 1))
+
+    @staticmethod
+    def from_catalog(df_music_info, track_uniques, id_to_cluster=None, n_buckets=20):
+        # Energies and clusters aligned with the item codes of the ALS model
+        item_energies = df_music_info.set_index('track_id')['energy'].reindex(track_uniques).fillna(-1).to_numpy()
+        item_clusters = None
+        if id_to_cluster is not None:
+            item_clusters = id_to_cluster.reindex(track_uniques).fillna(-1).to_numpy()
+        return EnergyBucketIndex(item_energies, n_buckets, item_clusters)
+
+    def _bucket(self, energies):
+        return np.clip((np.asarray(energies) * self.n_buckets).astype(np.int64), 0, self.n_buckets - 1)
+
+    def _ranges(self, first_bucket, last_bucket, clusters):
+        if clusters is None:
+            return [(self.offsets[first_bucket * self.n_clusters], self.offsets[(last_bucket + 1) * self.n_clusters])]
+        cluster_codes = [self.cluster_codes[cluster] for cluster in clusters if cluster in self.cluster_codes]
+        return [(self.offsets[bucket * self.n_clusters + code], self.offsets[bucket * self.n_clusters + code + 1])
+                for bucket in range(first_bucket, last_bucket + 1) for code in cluster_codes]
+
+    def recommend(self, item_factors, user_vector, energy, N=10, energy_margin=0.05, user_items=None, exclude_items=None, clusters=None):
+        # Best-scored items with |item energy - energy| <= energy_margin, widening the window until N are found
+        user_vector = np.asarray(user_vector, dtype=np.float32)
+        excluded = np.zeros(0, dtype=np.int64)
+        if user_items is not None:
+            excluded = np.concatenate((excluded, user_items.indices))
+        if exclude_items is not None:
+            excluded = np.concatenate((excluded, np.asarray(exclude_items, dtype=np.int64)))
+
+        margin = energy_margin
+        while True:
+            first_bucket, last_bucket = self._bucket([energy - margin, energy + margin])
+            positions, scores = [], []
+            for start, end in self._ranges(first_bucket, last_bucket, clusters):
+                if end > start:
+                    positions.append(np.arange(start, end))
+                    scores.append(np.asarray(item_factors[self.item_codes[start:end]], dtype=np.float32) @ user_vector)
+            if positions:
+                positions, scores = np.concatenate(positions), np.concatenate(scores)
+                keep = (np.abs(self.energies[positions] - energy) <= margin) & ~np.isin(self.item_codes[positions], excluded)
+                positions, scores = positions[keep], scores[keep]
+            else:
+                positions, scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+            covers_everything = energy - margin <= 0 and energy + margin >= 1
+            if len(positions) >= N or covers_everything:
+                break
+            margin += 1 / self.n_buckets
+
+        top = np.argsort(-scores)[:N]
+        return self.item_codes[positions[top]], scores[top], self.energies[positions[top]]
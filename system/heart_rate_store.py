@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class HeartRateSeries:
+    # Per-minute view of one member's heart rates; indexable like the list it replaces
+    def __init__(self, bpm, variation, smoothed=None):
+        self.bpm = bpm
+        self.variation = variation
+        self.smoothed = smoothed
+
+    def __len__(self):
+        return len(self.bpm)
+
+    def __getitem__(self, minute):
+        return self.bpm[minute]
+
+    def tolist(self):
+        return self.bpm.tolist()
+
+
+class HeartRateStore:
+    def __init__(self, df_heart_rates, samples_per_minute=1, smoothing_window=None, user_column='User_ID', heart_rate_column='Heart_Rate'):
+        user_ids = df_heart_rates[user_column].to_numpy()
+        heart_rates = df_heart_rates[heart_rate_column].to_numpy(dtype=np.float64)
+
+        # Group samples by user in one contiguous array (stable sort keeps each user's time order)
+        if len(user_ids) > 1 and np.any(user_ids[1:] < user_ids[:-1]):
+            order = np.argsort(user_ids, kind='stable')
+            user_ids, heart_rates = user_ids[order], heart_rates[order]
+        self.user_ids, starts, counts = np.unique(user_ids, return_index=True, return_counts=True)
+
+        # Per-minute mean when the source has several samples per minute (incomplete trailing minutes are dropped)
+        minutes = counts // samples_per_minute
+        self.offsets = np.zeros(len(minutes) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(minutes)
+        self.bpm = np.empty(self.offsets[-1], dtype=np.float64)
+        for i, (start, n_minutes) in enumerate(zip(starts, minutes)):
+            samples = heart_rates[start:start + n_minutes * samples_per_minute]
+            self.bpm[self.offsets[i]:self.offsets[i + 1]] = samples.reshape(n_minutes, samples_per_minute).mean(axis=1)
+
+        # Minute-to-minute variation, 0 at the first minute of every series
+        self.variation = np.zeros_like(self.bpm)
+        self.variation[1:] = np.diff(self.bpm)
+        self.variation[self.offsets[:-1][minutes > 0]] = 0
+
+        self.smoothed = None
+        if smoothing_window is not None and smoothing_window > 1:
+            self.smoothed = np.empty_like(self.bpm)
+            for i in range(len(minutes)):
+                series = self.bpm[self.offsets[i]:self.offsets[i + 1]]
+                # Trailing moving average, shorter window at the start so no future minutes are used
+                cumulative = np.concatenate(([0.0], np.cumsum(series)))
+                window = np.minimum(np.arange(1, len(series) + 1), smoothing_window)
+                positions = np.arange(1, len(series) + 1)
+                self.smoothed[self.offsets[i]:self.offsets[i + 1]] = (cumulative[positions] - cumulative[positions - window]) / window
+
+    def _position(self, user_id):
+        position = np.searchsorted(self.user_ids, user_id)
+        if position >= len(self.user_ids) or self.user_ids[position] != user_id:
+            return None
+        return position
+
+    def __contains__(self, user_id):
+        return self._position(user_id) is not None
+
+    def user_series(self, user_id):
+        # Zero-copy views; an empty series for members without recordings, as the DataFrame filter would give
+        position = self._position(user_id)
+        if position is None:
+            empty = self.bpm[:0]
+            return HeartRateSeries(empty, self.variation[:0], None if self.smoothed is None else self.smoothed[:0])
+        window = slice(self.offsets[position], self.offsets[position + 1])
+        return HeartRateSeries(self.bpm[window], self.variation[window], None if self.smoothed is None else self.smoothed[window])
@@ -1,10 +1,12 @@
 from implicit.als import AlternatingLeastSquares
 
 class ALSRecommender:
-    def __init__(self, interaction_matrix, track_uniques, df_music_info, als_model=None):
+    def __init__(self, interaction_matrix, track_uniques, df_music_info, als_model=None, quantized_factors=None, energy_index=None):
         self.interaction_matrix = interaction_matrix
         self.track_uniques = track_uniques
         self.df_music_info = df_music_info
+        self.quantized_factors = quantized_factors # Optional reduced-precision item factors (QuantizedItemFactors)
+        self.energy_index = energy_index # Optional EnergyBucketIndex for energy-constrained retrieval
 
         if als_model is None:
             self.als_model = AlternatingLeastSquares(factors=100, regularization=0.1, iterations=20, num_threads=1)
@@ -21,7 +23,10 @@ class ALSRecommender:
         user_items = self.interaction_matrix.tocsr()[user_index]
 
 
-        top_n_recommendations_indexes, top_n_recommendations_scores = self.als_model.recommend(user_index, user_items, N=n, filter_already_liked_items=True)
+        if self.quantized_factors is not None:
+            top_n_recommendations_indexes, top_n_recommendations_scores = self.quantized_factors.recommend(self.als_model.user_factors[user_index], user_items, N=n, filter_already_liked_items=True)
+        else:
+            top_n_recommendations_indexes, top_n_recommendations_scores = self.als_model.recommend(user_index, user_items, N=n, filter_already_liked_items=True)
 
         # for i in range(len(top_n_recommendations_indexes)):
         #     print(f"Track ID: {self.track_uniques[top_n_recommendations_indexes[i]]}, Similarity: {top_n_recommendations_scores[i]}")
@@ -34,6 +39,19 @@ class ALSRecommender:
         self.recommendations = [(track_id, energy, similarity, False) for (track_id, energy), similarity in zip(df_filtered.itertuples(index=False, name=None), top_n_recommendations_scores)]
         return self.recommendations
 
+    def make_energy_recommendations(self, user_index, energy, n=10, energy_margin=0.05, exclude_track_ids=None, clusters=None):
+        # Best tracks for the user around an energy level, scoring only the matching buckets of the energy index
+        if self.energy_index is None:
+            raise ValueError("No energy index available. Please create the recommender with an EnergyBucketIndex.")
+
+        user_items = self.interaction_matrix.tocsr()[user_index]
+        exclude_items = None
+        if exclude_track_ids is not None:
+            exclude_items = self.track_uniques.get_indexer(exclude_track_ids)
+        item_codes, scores, energies = self.energy_index.recommend(self.als_model.item_factors, self.als_model.user_factors[user_index], energy, n,
+                                                                   energy_margin, user_items, exclude_items, clusters)
+        track_ids = self.track_uniques[item_codes].tolist()
+        return [(track_id, track_energy, similarity, False) for track_id, track_energy, similarity in zip(track_ids, energies, scores)]
     
     def recommend_song(self, energy, energy_margin=0.05):
         if self.recommendations is None:
@@ -96,7 +114,7 @@ class KmeansContentBasedRecommender:
     
 
 class HybridRecommender:
-    def __init__(self, interaction_matrix, track_uniques, df_music_info, df_users, id_to_cluster, recommendations = None, als_recommender = None, content_based_recommender = None, alpha = 2):
+    def __init__(self, interaction_matrix, track_uniques, df_music_info, df_users, id_to_cluster, recommendations = None, als_recommender = None, content_based_recommender = None, alpha = 2, energy_candidates = 10):
         if als_recommender is not None:
             self.collaborative_als_recommender = als_recommender
         else:
@@ -111,17 +129,17 @@ class HybridRecommender:
         self.df_users = df_users
         self.id_to_cluster = id_to_cluster
         self.alpha = alpha  # Alpha is a parameter to control the influence of content-based recommendations
+        self.energy_candidates = energy_candidates # Tracks fetched from the energy index when no recommendation is close enough
         self.recommendations = recommendations # List of tuples (track_id, energy, similarity, has been recommended)
 
     
-    def make_recommendations(self, user_index, n=100):
-
+    def cluster_preferences(self, user_index):
         user_id = self.df_users['user_id'].unique()[user_index]
         user_history = self.df_users[self.df_users['user_id'] == user_id]['track_id']
-        collaborative_recomendations = self.collaborative_als_recommender.make_recommendations(user_index, n)
-        content_based_cluster_recommendation = self.content_based_recommender.make_cluster_recommendation(user_history)
-        self.recommendations = []
-        
+        return self.content_based_recommender.make_cluster_recommendation(user_history)
+
+    def hybrid_scores(self, collaborative_recomendations, content_based_cluster_recommendation):
+        recommendations = []
         #We will apply a penalization to the collaborative filtering recommendation based on the user cluster preferences obtained by the content-based recommendation
         for track_id, energy, similarity, has_been_recommended in collaborative_recomendations:
             cluster_presence = 0 #Default multiplier. Used if the song's cluster is not in the user's cluster preferences (content-based recommendation)
@@ -131,14 +149,24 @@ class HybridRecommender:
             
             #print(track_id, song_cluster, multiplier)
 
-            self.recommendations.append((track_id, energy, similarity + cluster_presence * self.alpha, has_been_recommended)) # confidence = colab_conficence + cluster_presence * self.alpha
-        self.recommendations = sorted(self.recommendations, key=lambda x: x[2], reverse=True)  # Sort new similarity
+            recommendations.append((track_id, energy, similarity + cluster_presence * self.alpha, has_been_recommended)) # confidence = colab_conficence + cluster_presence * self.alpha
+        return sorted(recommendations, key=lambda x: x[2], reverse=True)  # Sort new similarity
+
+    def make_recommendations(self, user_index, n=100):
+        collaborative_recomendations = self.collaborative_als_recommender.make_recommendations(user_index, n)
+        content_based_cluster_recommendation = self.cluster_preferences(user_index)
+        self.recommendations = self.hybrid_scores(collaborative_recomendations, content_based_cluster_recommendation)
+
+    def make_energy_recommendations(self, user_index, energy, n=10, energy_margin=0.05, exclude_track_ids=None):
+        # Hybrid-scored tracks around an energy level, retrieved from the energy index instead of filtering the top-n
+        collaborative_recomendations = self.collaborative_als_recommender.make_energy_recommendations(user_index, energy, n, energy_margin, exclude_track_ids)
+        return self.hybrid_scores(collaborative_recomendations, self.cluster_preferences(user_index))
 
 
     def make_recommendations_only_collaborative(self, user_index, n=100):
         self.recommendations = self.collaborative_als_recommender.make_recommendations(user_index, n)
     
-    def recommend_song(self, energy, energy_margin=0.05):
+    def recommend_song(self, energy, energy_margin=0.05, user_index=None):
         if self.recommendations is None:
             raise ValueError("No recommendations available. Please call make_recommendations first.")
         
@@ -155,6 +183,15 @@ class HybridRecommender:
             if not has_been_recommended and distance < distance_to_energy:
                 closest_track_index = i
                 distance_to_energy = distance
+
+        # Nothing close enough among the recommendations: fetch the best tracks at this energy directly
+        if user_index is not None and self.collaborative_als_recommender.energy_index is not None:
+            exclude_track_ids = [track_id for track_id, _, _, _ in self.recommendations]
+            energy_recommendations = self.make_energy_recommendations(user_index, energy, self.energy_candidates, energy_margin, exclude_track_ids)
+            if energy_recommendations:
+                track_id, track_energy, similarity, _ = energy_recommendations[0]
+                self.recommendations.append((track_id, track_energy, similarity, True))
+                return (track_id, track_energy)
         
         if closest_track_index is not None:
             track_id, track_energy, _, _= self.recommendations[closest_track_index]
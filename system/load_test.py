@@ -0,0 +1,204 @@
+import argparse
+import contextlib
+import os
+import random
+import resource
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from system.resources import Resources
+from system.session import HeadlessSession, create_session_options
+from system.serving import ServingPool, PooledSession
+from system.shared_model import SharedModel
+
+
+def _rss_mb():
+    # Current resident set size on Linux, peak RSS elsewhere
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LoadGenerator:
+    def __init__(self, session_factory, user_ids, concurrency=10, ramp_up=0.0, think_time=0.0, max_steps=None, seed=0):
+        self.session_factory = session_factory
+        self.user_ids = list(user_ids)
+        self.concurrency = concurrency
+        self.ramp_up = ramp_up
+        self.think_time = think_time
+        self.max_steps = max_steps
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.completed_sessions = 0
+        self.peak_rss = 0.0
+
+    def _record(self, operation, elapsed):
+        with self.lock:
+            self.latencies[operation].append(elapsed)
+
+    def _record_error(self, operation, error):
+        with self.lock:
+            self.errors[f"{operation}: {type(error).__name__}"] += 1
+
+    def _sample_memory(self):
+        rss = _rss_mb()
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+
+    def _think(self, rng):
+        if self.think_time > 0:
+            time.sleep(rng.uniform(0.5, 1.5) * self.think_time) # +-50% jitter so users do not move in lockstep
+
+    def _run_user(self, slot, user_id):
+        rng = random.Random(self.seed + slot)
+        if slot < self.concurrency and self.ramp_up > 0:
+            time.sleep(self.ramp_up * slot / self.concurrency)
+
+        start = time.perf_counter()
+        try:
+            session = self.session_factory(user_id)
+            session.start_session()
+        except Exception as error:
+            self._record_error('start_session', error)
+            traceback.print_exc()
+            return
+        self._record('start_session', time.perf_counter() - start)
+        self._sample_memory()
+
+        steps = 0
+        try:
+            while self.max_steps is None or steps < self.max_steps:
+                self._think(rng)
+                start = time.perf_counter()
+                try:
+                    _, track_id = session.pass_time()
+                except Exception as error:
+                    self._record_error('pass_time', error)
+                    break
+                self._record('pass_time', time.perf_counter() - start)
+                steps += 1
+                if track_id is None:
+                    break # Session has ended
+        finally:
+            # Also after an error or --max-steps, so serving workers do not keep abandoned sessions
+            try:
+                session.end_session()
+            except Exception as error:
+                self._record_error('end_session', error)
+        self._sample_memory()
+
+        with self.lock:
+            self.completed_sessions += 1
+
+    def run(self):
+        rss_start = _rss_mb()
+        self.peak_rss = rss_start
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            list(executor.map(self._run_user, range(len(self.user_ids)), self.user_ids))
+        elapsed = time.perf_counter() - start
+        return self.report(elapsed, rss_start, _rss_mb())
+
+    def report(self, elapsed, rss_start, rss_end):
+        report = {
+            'elapsed_s': elapsed,
+            'sessions': len(self.user_ids),
+            'completed_sessions': self.completed_sessions,
+            'errors': dict(self.errors),
+            'rss_start_mb': rss_start,
+            'rss_end_mb': rss_end,
+            'rss_peak_mb': self.peak_rss,
+            'rss_growth_mb': rss_end - rss_start,
+            'operations': {},
+        }
+        for operation, latencies in self.latencies.items():
+            latencies = np.array(latencies) * 1000
+            p50, p90, p95, p99 = np.percentile(latencies, [50, 90, 95, 99])
+            report['operations'][operation] = {
+                'count': len(latencies),
+                'throughput_per_s': len(latencies) / elapsed,
+                'mean_ms': latencies.mean(),
+                'p50_ms': p50,
+                'p90_ms': p90,
+                'p95_ms': p95,
+                'p99_ms': p99,
+                'max_ms': latencies.max(),
+            }
+        return report
+
+
+def print_report(report):
+    print(f"Sessions: {report['completed_sessions']}/{report['sessions']} completed in {report['elapsed_s']:.1f} s")
+    for operation, stats in report['operations'].items():
+        print(f"{operation}: {stats['count']} calls, {stats['throughput_per_s']:.2f}/s, "
+              f"mean {stats['mean_ms']:.1f} ms, p50 {stats['p50_ms']:.1f} ms, p90 {stats['p90_ms']:.1f} ms, "
+              f"p95 {stats['p95_ms']:.1f} ms, p99 {stats['p99_ms']:.1f} ms, max {stats['max_ms']:.1f} ms")
+    print(f"Memory (RSS): start {report['rss_start_mb']:.1f} MB, end {report['rss_end_mb']:.1f} MB, "
+          f"peak {report['rss_peak_mb']:.1f} MB, growth {report['rss_growth_mb']:.1f} MB")
+    errors = report['errors']
+    print(f"Errors: {sum(errors.values())}")
+    for error, count in errors.items():
+        print(f"  {error}: {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent workout sessions against the recommender")
+    parser.add_argument('--base-dir', default=None, help="Directory containing resources/ (defaults to the working directory)")
+    parser.add_argument('--concurrency', type=int, default=10, help="Number of simultaneous sessions")
+    parser.add_argument('--sessions', type=int, default=None, help="Total sessions to run (defaults to --concurrency)")
+    parser.add_argument('--ramp-up', type=float, default=0.0, help="Seconds over which the first sessions are started")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Mean seconds between 'Pass time' clicks")
+    parser.add_argument('--max-steps', type=int, default=None, help="Maximum 'Pass time' clicks per session")
+    parser.add_argument('--n', type=int, default=100, help="Number of recommendations generated at session start")
+    parser.add_argument('--workers', type=int, default=0, help="Serve sessions from this many worker processes sharing one copy of the model (0 runs in-process)")
+    parser.add_argument('--candidate-pools', default=None, help="Precomputed candidate pool file used at session start")
+    parser.add_argument('--energy-index', action='store_true', help="Fetch tracks from the energy-bucketed index when no recommendation is close enough")
+    parser.add_argument('--quantized', action='store_true', help="Score with the quantized item factors in resources/models/quantized, as the app does")
+    parser.add_argument('--prefetch', action='store_true', help="Prefetch the next song during think time, as the app does")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="Keep the recommender's own prints")
+    args = parser.parse_args()
+
+    resources = Resources(args.base_dir)
+    sessions = args.sessions if args.sessions is not None else args.concurrency
+    traced_users = resources.heart_rate_store.user_ids
+    rng = random.Random(args.seed)
+    user_ids = [int(rng.choice(traced_users)) for _ in range(sessions)]
+
+    shared_model, serving_pool = None, None
+    try:
+        if args.workers > 0:
+            shared_model = SharedModel.publish(resources)
+            resources = None # Workers attach to the shared copy; drop the private one
+            serving_pool = ServingPool(shared_model, args.workers, args.base_dir, not args.verbose, args.candidate_pools, args.energy_index, args.prefetch, args.quantized)
+            session_factory = lambda user_id: PooledSession(serving_pool, user_id, args.n)
+        else:
+            candidate_pools, energy_index, quantized_factors, profiler = create_session_options(resources, args.candidate_pools, args.energy_index, args.quantized)
+            session_factory = lambda user_id: HeadlessSession(resources, user_id, args.n, candidate_pools, profiler, args.prefetch, energy_index, quantized_factors)
+
+        load_generator = LoadGenerator(session_factory, user_ids, args.concurrency, args.ramp_up, args.think_time, args.max_steps, args.seed)
+        if args.verbose:
+            report = load_generator.run()
+        else:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                report = load_generator.run()
+    finally:
+        if serving_pool is not None:
+            serving_pool.close()
+        if shared_model is not None:
+            shared_model.close()
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
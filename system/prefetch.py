@@ -0,0 +1,125 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from system.energy_calculator import FuzzyController
+
+MAX_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+_thread_state = threading.local()
+_in_flight = 0 # Speculations submitted and not finished, across every session of the process
+
+
+def _submit(readings, user_age, energies, cancelled):
+    # Skipped rather than queued when every prefetch thread is busy: a backlog only adds GIL contention to requests
+    global _executor, _in_flight
+    with _executor_lock:
+        if _in_flight >= MAX_WORKERS:
+            return False
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='song-prefetch')
+        _in_flight += 1
+    _executor.submit(_speculate, readings, user_age, energies, cancelled)
+    return True
+
+
+def _thread_fuzzy_controller():
+    # ControlSystemSimulation keeps state between compute calls, so every prefetch thread owns one
+    if not hasattr(_thread_state, 'fuzzy_controller'):
+        _thread_state.fuzzy_controller = FuzzyController()
+    return _thread_state.fuzzy_controller
+
+
+def _speculate(readings, user_age, energies, cancelled):
+    # Fills energies as it goes, so the most likely readings are usable before all of them are done
+    global _in_flight
+    try:
+        fuzzy_controller = _thread_fuzzy_controller()
+        for bpm, bpm_variation in readings:
+            if cancelled.is_set():
+                return
+            energies[(bpm, bpm_variation)] = fuzzy_controller.calculate_energy(bpm, bpm_variation, user_age)
+    finally:
+        with _executor_lock:
+            _in_flight -= 1
+
+
+class _PendingPrefetch:
+    def __init__(self, user_index, user_age, minute, energies, cancelled):
+        self.user_index = user_index
+        self.user_age = user_age
+        self.minute = minute
+        self.energies = energies # (bpm, variation) -> energy, for exact readings only
+        self.cancelled = cancelled
+
+
+class SongPrefetcher:
+    # Runs the fuzzy inference for the likely next heart-rate readings while the current song plays
+    def __init__(self, bpm_steps=2, variations=(0, 1, -1), max_prefetches=30):
+        # Readings are whole BPM and only exact matches are served, so a few readings are speculated per song:
+        # the last one and up to bpm_steps further along its trend (one step against it), each with a small variation
+        self.bpm_steps = bpm_steps
+        self.variations = variations
+        self.max_prefetches = max_prefetches # Per session
+        self.pending = None
+        self.prefetches = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def cancel(self):
+        if self.pending is not None:
+            self.pending.cancelled.set()
+        self.pending = None
+
+    def prefetch(self, music_recommender_2_stages, bpm_current, bpm_before=None):
+        # Call right after a song has been served, with the readings it was chosen from
+        energy_calculator = music_recommender_2_stages.energy_calculator
+        next_minute = energy_calculator.get_session_minute()
+        self.cancel()
+        if bpm_current is None or not float(bpm_current).is_integer() or next_minute >= len(energy_calculator.df_heart_rates):
+            return
+        if self.prefetches >= self.max_prefetches:
+            return
+
+        trend = -1 if bpm_before is not None and bpm_current < bpm_before else 1
+        bpm_offsets = [0] + [trend * step for step in range(1, self.bpm_steps + 1)] + [-trend]
+        bpm_current = float(bpm_current)
+        readings = [(bpm_current + bpm_offset, float(variation)) for bpm_offset in bpm_offsets for variation in self.variations]
+        pending = _PendingPrefetch(music_recommender_2_stages.user_index, energy_calculator.user_age, next_minute, {}, threading.Event())
+        if not _submit(readings, energy_calculator.user_age, pending.energies, pending.cancelled):
+            self.skipped += 1
+            return
+        self.prefetches += 1
+        self.pending = pending
+
+    def _prefetched_energy(self, music_recommender_2_stages, pending):
+        energy_calculator = music_recommender_2_stages.energy_calculator
+        minute = energy_calculator.get_session_minute()
+        if pending is None or pending.user_index != music_recommender_2_stages.user_index or pending.user_age != energy_calculator.user_age:
+            return None # Left over from another member's session
+        if pending.minute != minute or minute == 0 or minute >= len(energy_calculator.df_heart_rates):
+            return None
+
+        bpm_current, bpm_before, bpm_variation = energy_calculator.read_heart_rates()
+        energy = pending.energies.get((float(bpm_current), float(bpm_variation)))
+        if energy is None:
+            return None # Reading not speculated, or not reached yet
+        return energy, bpm_current, bpm_before
+
+    def recommend_song(self, music_recommender_2_stages):
+        # Same result as MusicRecommender2Stages.recommend_song, without inference on the request path when the reading was anticipated
+        pending, self.pending = self.pending, None
+        prefetched = self._prefetched_energy(music_recommender_2_stages, pending)
+        if pending is not None:
+            pending.cancelled.set()
+        if prefetched is None:
+            if pending is not None:
+                self.misses += 1
+            return music_recommender_2_stages.recommend_song()
+
+        self.hits += 1
+        energy, bpm_current, bpm_before = prefetched
+        print(f"Energy level needed for recommendation (prefetched): {energy}")
+        return music_recommender_2_stages.recommend_song_for_energy(energy, bpm_current, bpm_before)
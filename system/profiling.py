@@ -0,0 +1,150 @@
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+FORMATS = ('pstats', 'collapsed')
+
+
+class _StackSampler:
+    # Samples one thread's call stack at a fixed interval; cost is bounded by the interval, not by the call count
+    def __init__(self, thread_id, base_depth, interval):
+        self.thread_id = thread_id
+        self.base_depth = base_depth
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+            stack = stack[self.base_depth:] # Only the frames below the profiled call
+            if stack:
+                self.stacks[';'.join(stack)] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, path):
+        # Collapsed stacks, the input format of flamegraph.pl and speedscope
+        with open(path, 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+class _ProfileCapture:
+    def __init__(self, profiler, path):
+        self.profiler = profiler
+        self.path = path
+        self.profile = None
+        self.sampler = None
+
+    def __enter__(self):
+        if self.profiler.output_format == 'pstats':
+            # cProfile cannot run in two threads at once; concurrent requests simply go unprofiled
+            if not self.profiler.pstats_lock.acquire(blocking=False):
+                return self
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            caller = sys._getframe(1)
+            base_depth = -1 # Samples keep the caller's own frame as their root
+            while caller is not None:
+                base_depth += 1
+                caller = caller.f_back
+            self.sampler = _StackSampler(threading.get_ident(), base_depth, self.profiler.interval)
+            self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profile is not None:
+            self.profile.disable()
+            self.profiler.pstats_lock.release()
+            self.profile.dump_stats(self.path)
+        elif self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(self.path)
+        else:
+            return False
+        self.profiler.enforce_retention()
+        return False
+
+
+class _NoCapture:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class RecommendationProfiler:
+    def __init__(self, output_dir, sample_rate=0.0, session_ids=(), output_format='pstats', max_files=200, interval=0.005, seed=None):
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown profile format {output_format}, expected one of {FORMATS}")
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate # Fraction of calls profiled
+        self.session_ids = set(session_ids) # Sessions whose every call is profiled
+        self.output_format = output_format
+        self.max_files = max_files # Oldest profiles are deleted beyond this count
+        self.interval = interval # Seconds between stack samples, collapsed format only
+        self.random = random.Random(seed)
+        self.pstats_lock = threading.Lock()
+        self.retention_lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+
+    @staticmethod
+    def from_env(environ=None):
+        # MUSIC_RECOMMENDER_PROFILE_DIR enables profiling; the other variables tune it
+        environ = os.environ if environ is None else environ
+        output_dir = environ.get('MUSIC_RECOMMENDER_PROFILE_DIR')
+        if not output_dir:
+            return None
+        session_ids = [int(session_id) for session_id in environ.get('MUSIC_RECOMMENDER_PROFILE_SESSIONS', '').split(',') if session_id.strip()]
+        return RecommendationProfiler(
+            output_dir,
+            sample_rate=float(environ.get('MUSIC_RECOMMENDER_PROFILE_SAMPLE_RATE', 0.0)),
+            session_ids=session_ids,
+            output_format=environ.get('MUSIC_RECOMMENDER_PROFILE_FORMAT', 'pstats'),
+            max_files=int(environ.get('MUSIC_RECOMMENDER_PROFILE_MAX_FILES', 200)),
+            interval=float(environ.get('MUSIC_RECOMMENDER_PROFILE_INTERVAL', 0.005)),
+        )
+
+    def should_profile(self, session_id=None):
+        if session_id is not None and session_id in self.session_ids:
+            return True
+        return self.sample_rate > 0 and self.random.random() < self.sample_rate
+
+    def profile(self, label, session_id=None):
+        if not self.should_profile(session_id):
+            return _NoCapture()
+        extension = 'prof' if self.output_format == 'pstats' else 'collapsed'
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', f"{time.time_ns()}_{label}_{session_id}")
+        return _ProfileCapture(self, os.path.join(self.output_dir, f"{name}.{extension}"))
+
+    def enforce_retention(self):
+        with self.retention_lock:
+            profiles = [entry for entry in os.scandir(self.output_dir) if entry.is_file() and entry.name.endswith(('.prof', '.collapsed'))]
+            if len(profiles) <= self.max_files:
+                return
+            profiles.sort(key=lambda entry: entry.name) # Names start with the capture time
+            for entry in profiles[:len(profiles) - self.max_files]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
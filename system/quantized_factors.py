@@ -0,0 +1,200 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from system.candidate_pools import model_fingerprint
+from system.resources import Resources
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+
+class QuantizedItemFactors:
+    def __init__(self, item_factors, precision='int8', full_factors=None, scales=None, chunk_size=2048, fingerprint=None, latency_ms=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+        self.precision = precision
+        self.chunk_size = chunk_size # Rows upcast at a time into one reused buffer, small enough to stay in cache
+
+        if scales is not None:
+            # Already quantized (see load)
+            self.factors = item_factors
+            self.scales = scales
+        elif precision == 'int8':
+            item_factors = np.asarray(item_factors, dtype=np.float32)
+            max_abs = np.abs(item_factors).max(axis=1)
+            self.scales = np.where(max_abs > 0, max_abs / 127, 1).astype(np.float32) # One scale per item row
+            self.factors = np.round(item_factors / self.scales[:, None]).astype(np.int8)
+        else:
+            self.factors = np.asarray(item_factors, dtype=precision)
+            self.scales = None
+
+        # Full-precision rows are only read for the re-ranked candidates, so they can be a memory-mapped file
+        self.full_factors = full_factors if full_factors is not None else item_factors
+        self.fingerprint = fingerprint # model_fingerprint of the model the factors were exported from
+        self.latency_ms = latency_ms # (quantized, full precision) recommend time measured at export
+
+    @staticmethod
+    def from_model(als_model, precision='int8'):
+        if hasattr(als_model, 'to_cpu'):
+            als_model = als_model.to_cpu()
+        return QuantizedItemFactors(als_model.item_factors, precision, fingerprint=model_fingerprint(als_model))
+
+    def save(self, directory, report=None):
+        # report: ranking_agreement output, whose latencies decide whether the app uses this export
+        os.makedirs(directory, exist_ok=True)
+        if report is not None:
+            latency_ms = [report['quantized_ms_per_call'], report['full_ms_per_call']]
+            np.save(os.path.join(directory, f'item_factors_{self.precision}_latency.npy'), np.array(latency_ms))
+        np.save(os.path.join(directory, f'item_factors_{self.precision}.npy'), self.factors)
+        if self.scales is not None:
+            np.save(os.path.join(directory, 'item_scales.npy'), self.scales)
+        np.save(os.path.join(directory, 'item_factors_float32.npy'), np.asarray(self.full_factors, dtype=np.float32))
+        if self.fingerprint is not None:
+            np.save(os.path.join(directory, 'item_factors_fingerprint.npy'), np.array([self.fingerprint], dtype=np.uint64))
+
+    @staticmethod
+    def exported_precisions(directory):
+        # Reduced-precision exports, most recent first; float32 only when nothing else was exported
+        exported = [precision for precision in ('int8', 'float16') if os.path.exists(os.path.join(directory, f'item_factors_{precision}.npy'))]
+        if exported:
+            return sorted(exported, key=lambda precision: os.path.getmtime(os.path.join(directory, f'item_factors_{precision}.npy')), reverse=True)
+        if os.path.exists(os.path.join(directory, 'item_factors_float32.npy')):
+            return ['float32']
+        return []
+
+    @staticmethod
+    def load(directory, precision=None):
+        if precision is None:
+            precisions = QuantizedItemFactors.exported_precisions(directory)
+            if not precisions:
+                raise FileNotFoundError(f"No exported item factors found in {directory}")
+            precision = precisions[0]
+        factors = np.load(os.path.join(directory, f'item_factors_{precision}.npy'))
+        scales = np.load(os.path.join(directory, 'item_scales.npy')) if precision == 'int8' else None
+        full_factors = np.load(os.path.join(directory, 'item_factors_float32.npy'), mmap_mode='r')
+        fingerprint_path = os.path.join(directory, 'item_factors_fingerprint.npy')
+        fingerprint = int(np.load(fingerprint_path)[0]) if os.path.exists(fingerprint_path) else None
+        latency_path = os.path.join(directory, f'item_factors_{precision}_latency.npy')
+        latency_ms = tuple(np.load(latency_path).tolist()) if os.path.exists(latency_path) else None
+        return QuantizedItemFactors(factors, precision, full_factors, scales, fingerprint=fingerprint, latency_ms=latency_ms)
+
+    @staticmethod
+    def load_faster(directory):
+        # The most recent export that scored faster than full precision when it was exported, or None
+        for precision in QuantizedItemFactors.exported_precisions(directory):
+            quantized_factors = QuantizedItemFactors.load(directory, precision)
+            if quantized_factors.faster_than_full_precision():
+                return quantized_factors
+        return None
+
+    def faster_than_full_precision(self):
+        return self.latency_ms is not None and self.latency_ms[0] < self.latency_ms[1]
+
+    def replace_model_factors(self, als_model):
+        # Points the model at the memory-mapped full-precision factors, so the pickled copy can be freed
+        if hasattr(als_model, 'to_cpu'):
+            raise ValueError("Quantized factors only replace the factors of a CPU model")
+        if self.full_factors.shape != als_model.item_factors.shape:
+            raise ValueError(f"Exported item factors have shape {self.full_factors.shape}, the model has {als_model.item_factors.shape}")
+        # Checked against the pickled factors, which are resident anyway, rather than by reading the mapped file
+        if self.fingerprint is None or self.fingerprint != model_fingerprint(als_model):
+            raise ValueError("Exported item factors come from a different model")
+        als_model.item_factors = self.full_factors
+
+    def nbytes(self):
+        return self.factors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def score(self, user_vector):
+        user_vector = np.asarray(user_vector, dtype=np.float32)
+        if self.precision == 'float32':
+            return self.factors @ user_vector
+        scores = np.empty(len(self.factors), dtype=np.float32)
+        buffer = np.empty((min(self.chunk_size, len(self.factors)), self.factors.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.factors), self.chunk_size):
+            chunk = self.factors[start:start + self.chunk_size]
+            np.copyto(buffer[:len(chunk)], chunk, casting='unsafe')
+            np.matmul(buffer[:len(chunk)], user_vector, out=scores[start:start + len(chunk)])
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+    def recommend(self, user_vector, user_items=None, N=100, filter_already_liked_items=True, rerank=4):
+        # Same return format as AlternatingLeastSquares.recommend: (item indexes, scores)
+        user_vector = np.asarray(user_vector, dtype=np.float32)
+        scores = self.score(user_vector)
+        if filter_already_liked_items and user_items is not None:
+            scores[user_items.indices] = -np.inf
+
+        n_candidates = min(N * rerank, len(scores))
+        candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates] if n_candidates < len(scores) else np.arange(len(scores))
+        candidates = candidates[np.isfinite(scores[candidates])]
+
+        # Re-rank the shortlist with the full-precision vectors
+        candidates = np.sort(candidates) # Sequential reads when full_factors is memory-mapped
+        exact_scores = np.asarray(self.full_factors[candidates], dtype=np.float32) @ user_vector
+        order = np.argsort(-exact_scores)[:N]
+        return candidates[order], exact_scores[order]
+
+
+def ranking_agreement(als_model, quantized_factors, interaction_matrix, user_indexes, N=100, rerank=4):
+    interaction_matrix = interaction_matrix.tocsr()
+    overlaps, top10_overlaps, top1_matches = [], [], []
+    full_time, quantized_time = 0.0, 0.0
+    for user_index in user_indexes:
+        user_items = interaction_matrix[user_index]
+
+        start = time.perf_counter()
+        full_indexes, _ = als_model.recommend(user_index, user_items, N=N, filter_already_liked_items=True)
+        full_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        quantized_indexes, _ = quantized_factors.recommend(als_model.user_factors[user_index], user_items, N, True, rerank)
+        quantized_time += time.perf_counter() - start
+
+        overlaps.append(len(np.intersect1d(full_indexes, quantized_indexes)) / len(full_indexes))
+        top10_overlaps.append(len(np.intersect1d(full_indexes[:10], quantized_indexes[:10])) / len(full_indexes[:10]))
+        top1_matches.append(full_indexes[0] == quantized_indexes[0])
+
+    full_bytes = np.asarray(quantized_factors.full_factors).nbytes
+    return {
+        'precision': quantized_factors.precision,
+        'users': len(overlaps),
+        'overlap_at_n': float(np.mean(overlaps)),
+        'overlap_at_10': float(np.mean(top10_overlaps)),
+        'top1_agreement': float(np.mean(top1_matches)),
+        'full_ms_per_call': 1000 * full_time / len(overlaps),
+        'quantized_ms_per_call': 1000 * quantized_time / len(overlaps),
+        'full_item_factors_mb': full_bytes / 2**20,
+        'quantized_item_factors_mb': quantized_factors.nbytes() / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the ALS item factors and report ranking agreement with full precision")
+    parser.add_argument('--base-dir', default=None, help="Directory containing resources/ (defaults to the working directory)")
+    parser.add_argument('--precision', choices=PRECISIONS, default='int8')
+    parser.add_argument('--n', type=int, default=100, help="Recommendations compared per user")
+    parser.add_argument('--rerank', type=int, default=4, help="Candidates re-ranked in full precision, as a multiple of --n")
+    parser.add_argument('--users', type=int, default=500, help="Users sampled for the report")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--export', default=None, help="Directory where the quantized factors are saved (e.g. resources/models/quantized)")
+    args = parser.parse_args()
+
+    resources = Resources(args.base_dir)
+    quantized_factors = QuantizedItemFactors.from_model(resources.als_model, args.precision)
+    n_users = resources.interaction_matrix.shape[0]
+    user_indexes = np.random.default_rng(args.seed).choice(n_users, size=min(args.users, n_users), replace=False)
+
+    report = ranking_agreement(resources.als_model, quantized_factors, resources.interaction_matrix, user_indexes, args.n, args.rerank)
+    for key, value in report.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+
+    if args.export is not None:
+        quantized_factors.save(args.export, report)
+        print(f"Saved {args.precision} item factors to {args.export}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import pickle
+import pandas as pd
+
+from system.heart_rate_store import HeartRateStore
+
+
+# Headless counterparts of the loaders used by the Streamlit pages, for tools that run outside the app
+def load_csv(base_path, file_name):
+    file_path = os.path.join(base_path, file_name)
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File {file_name} not found in {base_path}")
+    return pd.read_csv(file_path)
+
+
+def load_cluster_mapping(base_path, file_name):
+    return load_csv(base_path, file_name).set_index('track_id').iloc[:, 0]
+
+
+def load_index_data(base_path, file_name):
+    return pd.Index(load_csv(base_path, file_name).squeeze())
+
+
+def load_pickle(base_path, file_name):
+    file_path = os.path.join(base_path, file_name)
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File {file_name} not found in {base_path}")
+    with open(file_path, 'rb') as file:
+        return pickle.load(file)
+
+
+def create_df_music_info(df_music_source):
+    return df_music_source[['track_id', 'name', 'artist', 'energy', 'duration_ms']]
+
+
+class Resources:
+    def __init__(self, base_dir=None):
+        if base_dir is None:
+            base_dir = os.getcwd()
+        self.resources_dir = os.path.join(base_dir, 'resources')
+        self.data_dir = os.path.join(self.resources_dir, 'data')
+        self.model_dir = os.path.join(self.resources_dir, 'models')
+        self.matrices_dir = os.path.join(self.resources_dir, 'matrices')
+
+        self.df_gym = load_csv(self.data_dir, 'modified_gym_members_exercise_tracking.csv')
+        self.df_heart_rates = load_csv(self.data_dir, 'gym_members_heart_rates.csv')
+        self.heart_rate_store = HeartRateStore(self.df_heart_rates)
+        self.df_users = load_csv(self.data_dir, 'User Listening History_reduced.csv')
+        self.df_music_info = create_df_music_info(load_csv(self.data_dir, 'Music Info.csv'))
+        self.id_to_cluster = load_cluster_mapping(self.data_dir, 'track_clusters.csv')
+        self.user_uniques = load_index_data(self.data_dir, 'user_uniques.csv')
+        self.track_uniques = load_index_data(self.data_dir, 'track_uniques.csv')
+
+        self.interaction_matrix = load_pickle(self.matrices_dir, 'interaction_matrix.pkl')
+        self.als_model = load_pickle(self.model_dir, 'als_model.pkl')
+
+    def members_count(self):
+        return self.df_gym.shape[0]
+
+    def user_heart_rates(self, user_id):
+        return self.heart_rate_store.user_series(user_id)
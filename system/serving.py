@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import sys
+import threading
+import uuid
+
+from system.session import HeadlessSession, create_session_options
+from system.shared_model import SharedModel, SharedResources
+
+
+# Serving mode of the load-test harness (python -m system.load_test --workers N). The Streamlit pages keep
+# running their sessions in-process: each page rebuilds the recommenders on every rerun from st.session_state.
+
+
+def _worker_main(connection, spec, base_dir, quiet, candidate_pools_path, use_energy_index, prefetch, quantized):
+    if quiet:
+        sys.stdout = open(os.devnull, 'w') # The recommender prints on every song
+    shared_model = None
+    try:
+        shared_model = SharedModel.attach(spec)
+        resources = SharedResources(shared_model, base_dir)
+        candidate_pools, energy_index, quantized_factors, profiler = create_session_options(resources, candidate_pools_path, use_energy_index, quantized)
+    except Exception as error:
+        connection.send(('error', f"{type(error).__name__}: {error}"))
+        if shared_model is not None:
+            shared_model.close()
+        return
+    sessions = {}
+    connection.send(('ok', None)) # Ready
+    try:
+        while True:
+            request = connection.recv()
+            operation, session_id = request[0], request[1]
+            try:
+                if operation == 'stop':
+                    connection.send(('ok', None))
+                    break
+                elif operation == 'start_session':
+                    session = HeadlessSession(resources, request[2], request[3], candidate_pools, profiler, prefetch, energy_index, quantized_factors)
+                    session.start_session()
+                    sessions[session_id] = session
+                    result = None
+                elif operation == 'pass_time':
+                    if session_id not in sessions:
+                        raise ValueError(f"No session started with id {session_id}")
+                    result = sessions[session_id].pass_time()
+                elif operation == 'end_session':
+                    sessions.pop(session_id, None)
+                    result = None
+                else:
+                    raise ValueError(f"Unknown operation {operation}")
+                connection.send(('ok', result))
+            except Exception as error:
+                connection.send(('error', f"{type(error).__name__}: {error}"))
+    finally:
+        sessions.clear()
+        resources = None
+        shared_model.close()
+
+
+class ServingPool:
+    def __init__(self, shared_model, n_workers, base_dir=None, quiet=False, candidate_pools_path=None, energy_index=False, prefetch=False, quantized=False):
+        context = multiprocessing.get_context('spawn') # Forking after the BLAS/OpenMP runtimes are loaded is unsafe
+        self.n_workers = n_workers
+        self.connections = []
+        self.locks = []
+        self.processes = []
+        for _ in range(n_workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child_connection, shared_model.spec, base_dir, quiet,
+                                                                         candidate_pools_path, energy_index, prefetch, quantized), daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+
+        # Do not take traffic before every worker has attached the model
+        for worker, connection in enumerate(self.connections):
+            try:
+                status, result = connection.recv()
+            except EOFError:
+                self.processes[worker].join(timeout=10)
+                status, result = 'error', f"exited with code {self.processes[worker].exitcode}"
+            if status != 'ok':
+                self.terminate()
+                raise RuntimeError(f"Worker {worker} failed to start: {result}")
+
+    def worker_for(self, user_id):
+        # Sticky routing: a user's session state only lives in one worker
+        return user_id % self.n_workers
+
+    def _call(self, worker, *request):
+        with self.locks[worker]:
+            self.connections[worker].send(request)
+            status, result = self.connections[worker].recv()
+        if status == 'error':
+            raise RuntimeError(f"Worker {worker} failed: {result}")
+        return result
+
+    def start_session(self, session_id, user_id, n=100):
+        return self._call(self.worker_for(user_id), 'start_session', session_id, user_id, n)
+
+    def pass_time(self, session_id, user_id):
+        return self._call(self.worker_for(user_id), 'pass_time', session_id)
+
+    def end_session(self, session_id, user_id):
+        return self._call(self.worker_for(user_id), 'end_session', session_id)
+
+    def close(self):
+        for worker, process in enumerate(self.processes):
+            if process.is_alive():
+                try:
+                    self._call(worker, 'stop', None)
+                except (EOFError, OSError):
+                    pass
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+
+    def terminate(self):
+        # Without the stop handshake, for workers that may never have become ready
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join(timeout=10)
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+
+
+class PooledSession:
+    # Same interface as system.session.HeadlessSession, served by a ServingPool worker
+    def __init__(self, serving_pool, user_id, n=100):
+        self.serving_pool = serving_pool
+        self.user_id = user_id
+        self.n = n
+        self.session_id = uuid.uuid4().hex # The same member may have several simultaneous sessions under load
+        self.ended = False
+
+    def start_session(self):
+        self.serving_pool.start_session(self.session_id, self.user_id, self.n)
+
+    def pass_time(self):
+        minute, track_id = None, None
+        try:
+            minute, track_id = self.serving_pool.pass_time(self.session_id, self.user_id)
+        finally:
+            if track_id is None:
+                self.end_session() # Also when the worker failed, so it does not keep the session
+        return minute, track_id
+
+    def end_session(self):
+        if not self.ended:
+            self.ended = True
+            self.serving_pool.end_session(self.session_id, self.user_id)
@@ -0,0 +1,86 @@
+import os
+
+from system.energy_calculator import EnergyCalculator
+from system.hybrid_music_recommender import ALSRecommender, HybridRecommender
+from system.two_stage_system import MusicRecommender2Stages
+from system.candidate_pools import CandidatePoolStore, HISTORY_FILE, model_fingerprint
+from system.energy_index import EnergyBucketIndex
+from system.profiling import RecommendationProfiler
+from system.prefetch import SongPrefetcher
+from system.quantized_factors import QuantizedItemFactors
+
+
+class HeadlessSession:
+    # Replays what Exercise_music_recommender.py does on "Start session" and "Pass time", without Streamlit
+    def __init__(self, resources, user_id, n=100, candidate_pools=None, profiler=None, prefetch=False, energy_index=None, quantized_factors=None):
+        self.resources = resources
+        self.user_id = user_id
+        self.n = n
+        self.candidate_pools = candidate_pools
+        self.profiler = profiler
+        self.energy_index = energy_index
+        self.quantized_factors = quantized_factors
+        self.prefetcher = SongPrefetcher() if prefetch else None
+        self.session_minute = 0
+        self.user_heart_rates = None
+        self.recommendations = None
+
+    def start_session(self):
+        r = self.resources
+        self.session_minute = 0
+        self.user_heart_rates = r.user_heart_rates(self.user_id)
+
+        als_recommender = ALSRecommender(r.interaction_matrix, r.track_uniques, r.df_music_info, r.als_model, self.quantized_factors)
+        hybrid_recommender = HybridRecommender(r.interaction_matrix, r.track_uniques, r.df_music_info, r.df_users, r.id_to_cluster, als_recommender=als_recommender)
+        music_recommender_2_stages = MusicRecommender2Stages(None, hybrid_recommender, self.user_id, r.df_music_info, self.candidate_pools, self.profiler)
+        music_recommender_2_stages.make_recommendations(n=self.n)
+        self.recommendations = music_recommender_2_stages.get_recommendations()
+
+    def pass_time(self):
+        r = self.resources
+        energy_calculator = EnergyCalculator(r.df_gym.iloc[self.user_id], self.user_heart_rates, self.session_minute)
+        als_recommender = ALSRecommender(r.interaction_matrix, r.track_uniques, r.df_music_info, r.als_model, self.quantized_factors, self.energy_index)
+        hybrid_recommender = HybridRecommender(r.interaction_matrix, r.track_uniques, r.df_music_info, r.df_users, r.id_to_cluster, self.recommendations, als_recommender=als_recommender)
+        music_recommender_2_stages = MusicRecommender2Stages(energy_calculator, hybrid_recommender, self.user_id, r.df_music_info, profiler=self.profiler)
+
+        if self.prefetcher is not None:
+            minute, df_recommended_song, _, bpm_current, bpm_before = self.prefetcher.recommend_song(music_recommender_2_stages)
+        else:
+            minute, df_recommended_song, _, _, _ = music_recommender_2_stages.recommend_song()
+        self.session_minute = music_recommender_2_stages.get_session_minute()
+        if df_recommended_song is None:
+            return minute, None
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(music_recommender_2_stages, bpm_current, bpm_before)
+        return minute, df_recommended_song['track_id'].values[0]
+
+    def end_session(self):
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+
+
+def load_quantized_factors(resources):
+    # Same choice as the app: the newest export in resources/models/quantized that scored faster than full precision
+    directory = os.path.join(resources.model_dir, 'quantized')
+    quantized_factors = QuantizedItemFactors.load_faster(directory)
+    if quantized_factors is None:
+        print(f"No quantized item factors in {directory} scored faster than full precision; sessions use the full-precision model")
+        return None
+    quantized_factors.replace_model_factors(resources.als_model)
+    return quantized_factors
+
+
+def create_session_options(resources, candidate_pools_path=None, energy_index=False, quantized=False):
+    # Optional components shared by every session of a process (profiling follows MUSIC_RECOMMENDER_PROFILE_*, as in the app)
+    quantized_factors = load_quantized_factors(resources) if quantized else None
+    fingerprint = quantized_factors.fingerprint if quantized_factors is not None else model_fingerprint(resources.als_model)
+    candidate_pools = None
+    if candidate_pools_path is not None:
+        candidate_pools = CandidatePoolStore(candidate_pools_path, resources.track_uniques, resources.interaction_matrix, fingerprint=fingerprint,
+                                             history_path=os.path.join(resources.data_dir, HISTORY_FILE))
+        if candidate_pools.stale_reason is not None:
+            print(f"Candidate pools are stale because {candidate_pools.stale_reason}; sessions use live scoring")
+    index = None
+    if energy_index:
+        index = EnergyBucketIndex.from_catalog(resources.df_music_info, resources.track_uniques, resources.id_to_cluster)
+    return candidate_pools, index, quantized_factors, RecommendationProfiler.from_env()
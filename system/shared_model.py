@@ -0,0 +1,162 @@
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from implicit.als import AlternatingLeastSquares
+
+from system.heart_rate_store import HeartRateStore
+from system.resources import load_csv
+
+
+def _pack_strings(values):
+    # Variable-length strings as one UTF-8 buffer plus offsets, so they can live in shared memory
+    encoded = [str(value).encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8) if offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+    return buffer, offsets
+
+
+def _unpack_strings(buffer, offsets):
+    data = buffer.tobytes()
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _attach_segment(name):
+    # Attached segments are owned by the publishing process; only Python >= 3.13 lets us opt out of tracking
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedModel:
+    def __init__(self, arrays, segments, spec, owner):
+        self.arrays = arrays
+        self.segments = segments
+        self.spec = spec # Picklable description used by other processes to attach
+        self.owner = owner
+
+    @staticmethod
+    def publish(resources):
+        als_model = resources.als_model
+        if hasattr(als_model, 'to_cpu'):
+            als_model = als_model.to_cpu()
+        interaction_matrix = resources.interaction_matrix.tocsr()
+
+        # Catalog columns aligned with the item codes of the ALS model
+        df_catalog = resources.df_music_info.set_index('track_id').loc[resources.track_uniques]
+        names, names_offsets = _pack_strings(df_catalog['name'])
+        artists, artists_offsets = _pack_strings(df_catalog['artist'])
+
+        sources = {
+            'user_factors': np.ascontiguousarray(als_model.user_factors),
+            'item_factors': np.ascontiguousarray(als_model.item_factors),
+            'interaction_data': interaction_matrix.data,
+            'interaction_indices': interaction_matrix.indices,
+            'interaction_indptr': interaction_matrix.indptr,
+            'track_ids': np.array(resources.track_uniques, dtype='S'),
+            'track_energy': df_catalog['energy'].to_numpy(),
+            'track_duration_ms': df_catalog['duration_ms'].to_numpy(),
+            'track_names': names,
+            'track_names_offsets': names_offsets,
+            'track_artists': artists,
+            'track_artists_offsets': artists_offsets,
+            'cluster_track_ids': np.array(resources.id_to_cluster.index, dtype='S'),
+            'cluster_values': resources.id_to_cluster.to_numpy(),
+        }
+
+        arrays, segments = {}, []
+        spec = {'interaction_shape': interaction_matrix.shape, 'arrays': {}}
+        try:
+            for key, source in sources.items():
+                segment = shared_memory.SharedMemory(create=True, size=max(source.nbytes, 1))
+                segments.append(segment)
+                array = np.ndarray(source.shape, dtype=source.dtype, buffer=segment.buf)
+                array[...] = source
+                arrays[key] = array
+                spec['arrays'][key] = (segment.name, source.shape, source.dtype.str)
+        except Exception:
+            for segment in segments:
+                segment.close()
+                segment.unlink()
+            raise
+        return SharedModel(arrays, segments, spec, owner=True)
+
+    @staticmethod
+    def attach(spec):
+        arrays, segments = {}, []
+        for key, (name, shape, dtype) in spec['arrays'].items():
+            segment = _attach_segment(name)
+            segments.append(segment)
+            arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+        return SharedModel(arrays, segments, spec, owner=False)
+
+    def als_model(self):
+        # A CPU ALS model whose factors are views on the shared segments (no copy)
+        item_factors = self.arrays['item_factors']
+        als_model = AlternatingLeastSquares(factors=item_factors.shape[1], use_gpu=False)
+        als_model.user_factors = self.arrays['user_factors']
+        als_model.item_factors = item_factors
+        return als_model
+
+    def interaction_matrix(self):
+        return csr_matrix((self.arrays['interaction_data'], self.arrays['interaction_indices'], self.arrays['interaction_indptr']),
+                          shape=self.spec['interaction_shape'], copy=False)
+
+    def track_uniques(self):
+        return pd.Index(np.char.decode(self.arrays['track_ids'], 'ascii'))
+
+    def df_music_info(self):
+        # Numeric columns stay on shared memory; strings are decoded once per process because the recommenders key on them
+        return pd.DataFrame({
+            'track_id': np.char.decode(self.arrays['track_ids'], 'ascii').astype(object),
+            'name': _unpack_strings(self.arrays['track_names'], self.arrays['track_names_offsets']),
+            'artist': _unpack_strings(self.arrays['track_artists'], self.arrays['track_artists_offsets']),
+            'energy': self.arrays['track_energy'],
+            'duration_ms': self.arrays['track_duration_ms'],
+        }, copy=False)
+
+    def id_to_cluster(self):
+        track_ids = pd.Index(np.char.decode(self.arrays['cluster_track_ids'], 'ascii'), name='track_id')
+        return pd.Series(self.arrays['cluster_values'], index=track_ids, copy=False)
+
+    def close(self):
+        self.arrays = {}
+        for segment in self.segments:
+            try:
+                segment.close()
+            except BufferError:
+                pass # Views are still referenced elsewhere; the mapping goes away with them
+            if self.owner:
+                segment.unlink()
+        self.segments = []
+
+
+class SharedResources:
+    # Same attributes as system.resources.Resources, backed by an attached SharedModel plus the small per-user tables
+    def __init__(self, shared_model, base_dir=None):
+        if base_dir is None:
+            base_dir = os.getcwd()
+        self.data_dir = os.path.join(base_dir, 'resources', 'data')
+        self.model_dir = os.path.join(base_dir, 'resources', 'models')
+        self.shared_model = shared_model
+
+        self.df_gym = load_csv(self.data_dir, 'modified_gym_members_exercise_tracking.csv')
+        self.df_heart_rates = load_csv(self.data_dir, 'gym_members_heart_rates.csv')
+        self.heart_rate_store = HeartRateStore(self.df_heart_rates)
+        self.df_users = load_csv(self.data_dir, 'User Listening History_reduced.csv')
+
+        self.als_model = shared_model.als_model()
+        self.interaction_matrix = shared_model.interaction_matrix()
+        self.track_uniques = shared_model.track_uniques()
+        self.df_music_info = shared_model.df_music_info()
+        self.id_to_cluster = shared_model.id_to_cluster()
+
+    def members_count(self):
+        return self.df_gym.shape[0]
+
+    def user_heart_rates(self, user_id):
+        return self.heart_rate_store.user_series(user_id)
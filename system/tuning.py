@@ -0,0 +1,247 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from threadpoolctl import threadpool_limits
+from implicit.als import AlternatingLeastSquares
+
+from system.energy_calculator import FuzzyController
+from system.hybrid_music_recommender import ALSRecommender, HybridRecommender
+from system.resources import Resources
+
+
+def split_holdout(interaction_matrix, df_users, track_uniques, holdout=0.2, seed=0):
+    # Hides a random fraction of every user's listened tracks (users with a single track keep it)
+    matrix = interaction_matrix.tocsr()
+    n_users, n_items = matrix.shape
+    counts = np.diff(matrix.indptr)
+    rows = np.repeat(np.arange(n_users), counts)
+
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(matrix.nnz), rows))
+    rank_in_row = np.arange(matrix.nnz) - matrix.indptr[rows[order]]
+    # Every user keeps at least one track: an empty history would drop them from df_users and shift the user indexes
+    n_heldout = np.where(counts >= 2, np.minimum(np.maximum(1, np.round(counts * holdout)), counts - 1), 0).astype(np.int64)
+    heldout_mask = np.zeros(matrix.nnz, dtype=bool)
+    heldout_mask[order] = rank_in_row < n_heldout[rows[order]]
+
+    train_matrix = csr_matrix((matrix.data[~heldout_mask], (rows[~heldout_mask], matrix.indices[~heldout_mask])), shape=matrix.shape)
+    heldout_rows, heldout_items = rows[heldout_mask], matrix.indices[heldout_mask]
+    split_points = np.searchsorted(heldout_rows, np.arange(1, n_users))
+    heldout = dict(enumerate(np.split(heldout_items, split_points)))
+
+    # The content-based stage reads the history from df_users, so the held-out tracks are removed there too
+    user_indexes = pd.Index(df_users['user_id'].unique()).get_indexer(df_users['user_id'])
+    item_codes = track_uniques.get_indexer(df_users['track_id'])
+    heldout_keys = heldout_rows.astype(np.int64) * n_items + heldout_items
+    keep = ~np.isin(user_indexes.astype(np.int64) * n_items + item_codes, heldout_keys)
+    # HybridRecommender maps user indexes through df_users['user_id'].unique(), so first-appearance order must not change
+    order = np.argsort(user_indexes[keep], kind='stable')
+    df_users_train = df_users[keep].iloc[order]
+    return train_matrix, df_users_train, heldout
+
+
+def _session_energies(ages, series_list):
+    # Energy targets for every minute, as EnergyCalculator would compute them (minute 0 is the warm-up default)
+    fuzzy_controller = FuzzyController()
+    energies = []
+    for age, bpm in zip(ages, series_list):
+        user_energies = np.full(len(bpm), 0.6)
+        for minute in range(1, len(bpm)):
+            user_energies[minute] = fuzzy_controller.calculate_energy(bpm[minute], bpm[minute] - bpm[minute - 1], age)
+        energies.append(user_energies)
+    return energies
+
+
+_context = None
+
+
+def _init_worker(context):
+    global _context
+    _context = context
+    # One process per core: BLAS and implicit must not start their own thread pools on top
+    threadpool_limits(1)
+    context['als_model'].num_threads = 1
+
+
+def _collaborative_pools(user_indexes, max_n):
+    # ALS top-max_n and cluster preferences once per user; every smaller n is a prefix of the same ranking
+    c = _context
+    als_recommender = ALSRecommender(c['interaction_matrix'], c['track_uniques'], c['df_music_info'], c['als_model'])
+    hybrid_recommender = HybridRecommender(c['interaction_matrix'], c['track_uniques'], c['df_music_info'], c['df_users'], c['id_to_cluster'],
+                                           als_recommender=als_recommender)
+    return [(user_index, als_recommender.make_recommendations(user_index, max_n), hybrid_recommender.cluster_preferences(user_index))
+            for user_index in user_indexes]
+
+
+def _replay_sessions(hybrid_recommender, pools, user_indexes, energies, duration_minutes, energy_margin):
+    targets, chosen, song_times = [], [], []
+    exhausted_sessions = 0
+    for user_index in user_indexes:
+        user_energies = energies[user_index]
+        hybrid_recommender.recommendations = list(pools[user_index]) # recommend_song marks tracks as used
+        minute = 0
+        while minute < len(user_energies):
+            start = time.perf_counter()
+            song = hybrid_recommender.recommend_song(user_energies[minute], energy_margin)
+            song_times.append(time.perf_counter() - start)
+            if song is None:
+                exhausted_sessions += 1
+                break
+            song_id, song_energy = song
+            targets.append(user_energies[minute])
+            chosen.append(song_energy)
+            minute += duration_minutes[song_id]
+    return targets, chosen, song_times, exhausted_sessions
+
+
+def _evaluate(alpha, n, energy_margins, k):
+    c = _context
+    hybrid_recommender = HybridRecommender(c['interaction_matrix'], c['track_uniques'], c['df_music_info'], c['df_users'], c['id_to_cluster'],
+                                           als_recommender=ALSRecommender(c['interaction_matrix'], c['track_uniques'], c['df_music_info'], c['als_model']),
+                                           alpha=alpha)
+
+    hits_at_k, recall_at_k, recall_at_n = [], [], []
+    pools = {}
+    for user_index in c['user_indexes']:
+        collaborative_recommendations, cluster_preferences = c['collaborative_pools'][user_index]
+        recommendations = hybrid_recommender.hybrid_scores(collaborative_recommendations[:n], cluster_preferences)
+        pools[user_index] = recommendations
+
+        heldout = c['heldout'][user_index]
+        codes = c['track_uniques'].get_indexer([track_id for track_id, _, _, _ in recommendations])
+        hits = np.isin(codes, heldout)
+        hits_at_k.append(hits[:k].any())
+        recall_at_k.append(hits[:k].sum() / len(heldout))
+        recall_at_n.append(hits.sum() / len(heldout))
+
+    results = []
+    for energy_margin in energy_margins:
+        targets, chosen, _, exhausted_sessions = _replay_sessions(hybrid_recommender, pools, c['user_indexes'], c['energies'], c['duration_minutes'], energy_margin)
+        errors = np.abs(np.array(targets) - np.array(chosen))
+        results.append({
+            'alpha': alpha,
+            'n': n,
+            'energy_margin': energy_margin,
+            f'hit_rate@{k}': float(np.mean(hits_at_k)),
+            f'recall@{k}': float(np.mean(recall_at_k)),
+            'recall@n': float(np.mean(recall_at_n)),
+            'mean_energy_error': float(errors.mean()) if len(errors) else np.nan,
+            'out_of_margin_rate': float((errors > energy_margin).mean()) if len(errors) else np.nan,
+            'exhausted_session_rate': exhausted_sessions / len(c['user_indexes']),
+        })
+    return results
+
+
+def _time_calls(alpha, n, energy_margins, user_indexes):
+    # Run serially, alone on the machine: the latency columns are what n is chosen on
+    c = _context
+    hybrid_recommender = HybridRecommender(c['interaction_matrix'], c['track_uniques'], c['df_music_info'], c['df_users'], c['id_to_cluster'],
+                                           als_recommender=ALSRecommender(c['interaction_matrix'], c['track_uniques'], c['df_music_info'], c['als_model']),
+                                           alpha=alpha)
+    recommend_times = []
+    pools = {}
+    for user_index in user_indexes:
+        start = time.perf_counter()
+        hybrid_recommender.make_recommendations(user_index, n)
+        recommend_times.append(time.perf_counter() - start)
+        pools[user_index] = hybrid_recommender.get_recommendations()
+
+    song_times = {}
+    for energy_margin in energy_margins:
+        _, _, times, _ = _replay_sessions(hybrid_recommender, pools, user_indexes, c['energies'], c['duration_minutes'], energy_margin)
+        song_times[energy_margin] = 1000 * float(np.mean(times)) if times else np.nan
+    return 1000 * float(np.mean(recommend_times)), song_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep alpha, candidate count and energy margin on held-out listening history")
+    parser.add_argument('--base-dir', default=None, help="Directory containing resources/ (defaults to the working directory)")
+    parser.add_argument('--alphas', type=float, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--ns', type=int, nargs='+', default=[25, 50, 100, 200])
+    parser.add_argument('--energy-margins', type=float, nargs='+', default=[0.025, 0.05, 0.1])
+    parser.add_argument('--k', type=int, default=10, help="Cut-off for hit rate and recall")
+    parser.add_argument('--holdout', type=float, default=0.2, help="Fraction of each user's history held out")
+    parser.add_argument('--users', type=int, default=None, help="Evaluate a random sample of users")
+    parser.add_argument('--timing-users', type=int, default=100, help="Users replayed in the serial pass that measures per-call times")
+    parser.add_argument('--reuse-model', action='store_true', help="Score with the deployed model instead of retraining without the held-out tracks (leaks them)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='tuning_results.csv')
+    args = parser.parse_args()
+
+    resources = Resources(args.base_dir)
+    train_matrix, df_users_train, heldout = split_holdout(resources.interaction_matrix, resources.df_users, resources.track_uniques, args.holdout, args.seed)
+
+    if args.reuse_model:
+        als_model = resources.als_model
+    else:
+        factors = resources.als_model.item_factors.shape[1]
+        als_model = AlternatingLeastSquares(factors=factors, regularization=0.1, iterations=20, num_threads=1, random_state=args.seed)
+        als_model.fit(train_matrix)
+        if hasattr(als_model, 'to_cpu'):
+            als_model = als_model.to_cpu()
+
+    # Users with held-out tracks and a recorded heart-rate trace
+    user_indexes = [user_index for user_index, items in heldout.items() if len(items) > 0 and user_index in resources.heart_rate_store and user_index < len(resources.df_gym)]
+    if args.users is not None and args.users < len(user_indexes):
+        user_indexes = sorted(np.random.default_rng(args.seed).choice(user_indexes, size=args.users, replace=False).tolist())
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as executor:
+        # Fuzzy inference does not depend on the swept parameters, so it runs once per user
+        chunks = np.array_split(np.array(user_indexes), max(1, min(args.workers, len(user_indexes))))
+        ages = [resources.df_gym['Age'].to_numpy()[chunk] for chunk in chunks]
+        series = [[resources.heart_rate_store.user_series(user_index).bpm for user_index in chunk] for chunk in chunks]
+        energies = dict(zip(user_indexes, itertools.chain.from_iterable(executor.map(_session_energies, ages, series))))
+
+    df_music_info = resources.df_music_info
+    duration_minutes = dict(zip(df_music_info['track_id'], df_music_info['duration_ms'] // 60000))
+    worker_context = {
+        'interaction_matrix': train_matrix,
+        'track_uniques': resources.track_uniques,
+        'df_music_info': df_music_info,
+        'df_users': df_users_train,
+        'id_to_cluster': resources.id_to_cluster,
+        'als_model': als_model,
+        'user_indexes': user_indexes,
+        'heldout': {user_index: heldout[user_index] for user_index in user_indexes},
+        'energies': energies,
+        'duration_minutes': duration_minutes,
+    }
+
+    chunks = [chunk.tolist() for chunk in np.array_split(np.array(user_indexes), max(1, min(args.workers, len(user_indexes))))]
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=_init_worker, initargs=(worker_context,)) as executor:
+        collaborative_pools = itertools.chain.from_iterable(executor.map(_collaborative_pools, chunks, [max(args.ns)] * len(chunks)))
+        worker_context['collaborative_pools'] = {user_index: (recommendations, preferences) for user_index, recommendations, preferences in collaborative_pools}
+
+    grid = list(itertools.product(args.alphas, args.ns))
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=_init_worker, initargs=(worker_context,)) as executor:
+        futures = [executor.submit(_evaluate, alpha, n, args.energy_margins, args.k) for alpha, n in grid]
+        rows = list(itertools.chain.from_iterable(future.result() for future in futures))
+
+    timing_users = user_indexes
+    if args.timing_users < len(user_indexes):
+        timing_users = sorted(np.random.default_rng(args.seed).choice(user_indexes, size=args.timing_users, replace=False).tolist())
+    _init_worker(worker_context) # Same single-threaded setup as the workers, in this process only
+    timings = {(alpha, n): _time_calls(alpha, n, args.energy_margins, timing_users) for alpha, n in grid}
+    for row in rows:
+        make_recommendations_ms, recommend_song_ms = timings[(row['alpha'], row['n'])]
+        row['make_recommendations_ms'] = make_recommendations_ms
+        row['recommend_song_ms'] = recommend_song_ms[row['energy_margin']]
+
+    df_results = pd.DataFrame(rows).sort_values(['alpha', 'n', 'energy_margin']).reset_index(drop=True)
+    df_results.to_csv(args.output, index=False)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(df_results.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+    print(f"Evaluated {len(user_indexes)} users; results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
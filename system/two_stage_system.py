@@ -1,22 +1,53 @@
+from contextlib import nullcontext
+
+
 class MusicRecommender2Stages:
-    def __init__(self, energy_calculator, hybrid_recommender, user_index, df_music_info):
+    def __init__(self, energy_calculator, hybrid_recommender, user_index, df_music_info, candidate_pools=None, profiler=None, energy_margin=0.05):
         self.energy_calculator = energy_calculator
         self.hybrid_recommender = hybrid_recommender
         self.user_index = user_index
         self.df_music_info = df_music_info
+        self.candidate_pools = candidate_pools # Precomputed pools (CandidatePoolStore), live scoring is used when missing or stale
+        self.profiler = profiler # Optional RecommendationProfiler, decides per call whether a profile is captured
+        self.energy_margin = energy_margin # Accepted distance between target and track energy (see system/tuning.py)
 
+    def _profile(self, label):
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.profile(label, self.user_index)
 
     def make_recommendations(self, n=100):
+        with self._profile('make_recommendations'):
+            self._make_recommendations(n)
+
+    def _make_recommendations(self, n):
+        if self.candidate_pools is not None:
+            recommendations = self.candidate_pools.get_recommendations(self.user_index, n)
+            if recommendations is not None:
+                self.hybrid_recommender.recommendations = recommendations
+                return
         self.hybrid_recommender.make_recommendations(self.user_index, n)
         
     
     def recommend_song(self, plot_consequent=False, plot_antecedent=False):
+        with self._profile('recommend_song'):
+            return self._recommend_song(plot_consequent, plot_antecedent)
+
+    def _recommend_song(self, plot_consequent, plot_antecedent):
         current_minute = self.energy_calculator.get_session_minute()
         energy, bpm_current, bpm_before = self.energy_calculator.calculate_energy(plot_consequent, plot_antecedent)
         if energy == -1:
             return current_minute, None, None, None, None # Session has ended
         print(f"Energy level needed for recommendation: {energy}")
-        song_id, _ = self.hybrid_recommender.recommend_song(energy)
+        return self._play_song(current_minute, energy, bpm_current, bpm_before)
+
+    def recommend_song_for_energy(self, energy, bpm_current, bpm_before):
+        # Same as recommend_song for a target energy that was already computed (see system/prefetch.py)
+        with self._profile('recommend_song'):
+            return self._play_song(self.get_session_minute(), energy, bpm_current, bpm_before)
+
+    def _play_song(self, current_minute, energy, bpm_current, bpm_before):
+        song_id, _ = self.hybrid_recommender.recommend_song(energy, self.energy_margin, self.user_index)
         song_duration_minutes = self.df_music_info[self.df_music_info['track_id'] == song_id]['duration_ms'].values[0] // 60000
         self.energy_calculator.pass_song_duration(song_duration_minutes)
         return current_minute, self.df_music_info[self.df_music_info['track_id'] == song_id], energy, bpm_current, bpm_before